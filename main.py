@@ -1,145 +1,374 @@
+import asyncio
 import csv
-import json
+import email.utils
+import hashlib
+import heapq
+import math
 import os
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import chain, islice
 from dotenv import load_dotenv
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
-import requests
+import aiohttp
+import orjson
 import phonenumbers
-import concurrent.futures
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    # pyarrow is optional; without it the standard library csv reader is used
+    pa = pacsv = None
+
+
+def getPositiveIntEnv(name: str, default: int) -> int:
+    """Reads an optional positive integer environment variable, failing with a clear message if it is malformed."""
+
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a positive integer, got {value!r}") from None
+    if number < 1:
+        raise ValueError(f"{name} must be a positive integer, got {number}")
+    return number
+
+
+# Environment variables are read once at import time
+load_dotenv()
+
+MAILJET_TOKEN = os.getenv("MAILJET_TOKEN")
+SENDER_NAME = os.getenv("SENDER_NAME")
+INPUT_FILE = os.getenv("INPUT_FILE")
+OUTPUT_FILE = os.getenv("OUTPUT_FILE")
+MAX_CONCURRENCY = getPositiveIntEnv("MAX_CONCURRENCY", 50)
 
 
 class Client:
-    def __init__(self, fields: Dict[str, str]):
-        """Initializes Client object with fields dictionary."""
-        self.fields = fields
+    # Based off of the API documentation on
+    # https://dev.mailjet.com/sms/guides/send-sms-api/
+    URL = "https://api.mailjet.com/v4/sms-send"
 
-    def postSMS(self, token: str, sender: str) -> Dict[str, Any]:
-        """Sends an sms from a client dictionary object using using MailJet with the input token and sender name."""
+    # Rate limiting and transient gateway errors are retried after Retry-After, or with exponential backoff
+    RETRY_TOTAL = 3
+    RETRY_BACKOFF = 0.2
+    RETRY_MAX_DELAY = 30.0
+    RETRY_STATUSES = (429, 502, 503, 504)
 
-        # Based off of the API documentation on
-        # https://dev.mailjet.com/sms/guides/send-sms-api/
+    # Slots avoid a per-instance __dict__, which adds up when streaming very large CSV files
+    __slots__ = ("fields", "payload", "invalidMessage")
 
-        error = False
-        errorMessage = ""
+    def __init__(self, fields: Dict[str, str], sender: str):
+        """Initializes Client object with fields dictionary, pre-serializing its request body from the sender name."""
+        self.fields = fields
+        self.payload = b""
+        self.invalidMessage = ""
+        self.preparePayload(sender)
 
+    def preparePayload(self, sender: str):
+        """Serializes the MailJet request body ahead of sending, with the number pre-formatted to E.164.
+        Records the error message instead if the number is invalid or a required field is missing."""
         try:
-            url = "https://api.mailjet.com/v4/sms-send"
-            headers = {
-                "Authorization": f"Bearer {token}",
-                "Content-type": "application/json",
-            }
             body = {
                 "Text": self.fields["text"],
                 "To": Client.parseToE164(self.fields["number"]),
                 "From": sender,
             }
+        except (KeyError, phonenumbers.NumberParseException) as e:
+            self.invalidMessage = str(e)
+            return
+
+        self.payload = orjson.dumps(body)
+
+    async def postSMS(self, session: aiohttp.ClientSession) -> Dict[str, Any]:
+        """Sends an sms from a client dictionary object using MailJet with the input session.
+        The session is expected to already carry the authorization and content type headers."""
 
-            x = requests.post(url, json=body, headers=headers, timeout=5)
-            res = json.loads(x.text)
+        # Clients that failed to prepare never reach the network
+        if self.invalidMessage:
+            return {"error": True, "errorMessage": self.invalidMessage, "client": self.fields}
 
-            # TODO this condition should be changed to actually reflect a failing response
-            if "StatusCode" in res:
-                raise Exception(res["ErrorMessage"])
+        # Only network and decoding failures raise; a rejected SMS is returned as a plain error result
+        try:
+            for attempt in range(Client.RETRY_TOTAL + 1):
+                # The body is always read so the connection goes back to the pool before any backoff
+                async with session.post(Client.URL, data=self.payload) as x:
+                    content = await x.read()
+                    retry = x.status in Client.RETRY_STATUSES and attempt < Client.RETRY_TOTAL
+                    retryAfter = x.headers.get("Retry-After")
+
+                if not retry:
+                    res = orjson.loads(content)
+                    break
+                await asyncio.sleep(Client.retryDelay(retryAfter, attempt))
         except Exception as e:
-            error = True
-            errorMessage = str(e)
+            return {"error": True, "errorMessage": str(e), "client": self.fields}
+
+        # TODO this condition should be changed to actually reflect a failing response
+        if "StatusCode" in res:
+            return {"error": True, "errorMessage": res.get("ErrorMessage", ""), "client": self.fields}
 
-        return {"error": error, "errorMessage": errorMessage, "client": self.fields}
+        return {"error": False, "errorMessage": "", "client": self.fields}
+
+    @staticmethod
+    def retryDelay(retryAfter: Optional[str], attempt: int) -> float:
+        """Gets the number of seconds to wait before the next attempt. A Retry-After header, given either in seconds
+        or as an HTTP date, takes precedence over the exponential backoff. The wait never exceeds RETRY_MAX_DELAY."""
+
+        if retryAfter:
+            try:
+                seconds = float(retryAfter)
+                if math.isfinite(seconds):
+                    return min(max(seconds, 0.0), Client.RETRY_MAX_DELAY)
+            except ValueError:
+                pass
+
+            try:
+                until = email.utils.parsedate_to_datetime(retryAfter)
+                return min(max((until - datetime.now(timezone.utc)).total_seconds(), 0.0), Client.RETRY_MAX_DELAY)
+            except (TypeError, ValueError):
+                pass
+
+        return min(Client.RETRY_BACKOFF * 2**attempt, Client.RETRY_MAX_DELAY)
 
     @staticmethod
+    @lru_cache(maxsize=100_000)
     def parseToE164(number: str) -> str:
-        """Parses a phone number string to comply with the E.164 international telephone numbering standard."""
+        """Parses a phone number string to comply with the E.164 international telephone numbering standard.
+        Results are memoized, so recurring numbers skip the phonenumbers parse entirely."""
 
         x = phonenumbers.parse(number, "AU")
         return phonenumbers.format_number(x, phonenumbers.PhoneNumberFormat.E164)
 
 
 class ClientCollection:
-    instance = None
+    # Capacity of the queues between the read, send and write stages
+    MAX_PENDING = 200
 
-    @staticmethod
-    def getInstance():
-        """Gets the current instance of ClientCollection if it doesn't currently exist."""
-        if not ClientCollection.instance:
-            ClientCollection.instance = ClientCollection()
-        return ClientCollection.instance
+    # Number of distinct messages remembered for duplicate detection
+    DEDUP_SIZE = 100_000
 
     def __init__(self):
-        """Constructor for the ClientCollection class. This method will load all environment variables."""
-        load_dotenv()
+        """Constructor for the ClientCollection class. This method will bind the module-level environment variables."""
+
+        self.MAILJET_TOKEN = MAILJET_TOKEN
+        self.SENDER_NAME = SENDER_NAME
+        self.INPUT_FILE = INPUT_FILE
+        self.OUTPUT_FILE = OUTPUT_FILE
+        self.MAX_CONCURRENCY = MAX_CONCURRENCY
 
-        self.MAILJET_TOKEN = os.getenv("MAILJET_TOKEN")
-        self.SENDER_NAME = os.getenv("SENDER_NAME")
-        self.INPUT_FILE = os.getenv("INPUT_FILE")
-        self.OUTPUT_FILE = os.getenv("OUTPUT_FILE")
+        self.requestHeaders = {
+            "Authorization": f"Bearer {self.MAILJET_TOKEN}",
+            "Content-type": "application/json",
+        }
 
     def loadClients(self):
-        """Regenerates all Client objects from a list of dictionaries."""
+        """Regenerates the stream of Client objects from the CSV file. Clients are created lazily as the
+        stream is consumed, so the whole file is never held in memory at once."""
 
-        # Get headers and data from CSV file
-        self.headers, dataRows = self.readCSV()
+        self.clientList: Iterator[Client] = (Client(dataRow, self.SENDER_NAME) for dataRow in self.readCSV())
 
-        self.clientList: List[Client] = []
-        for dataRow in dataRows:
-            self.clientList += [Client(dataRow)]
+    def readCSV(self) -> Iterator[Dict[str, str]]:
+        """Reads a csv file from the INPUT_FILE field and yields each row as a dictionary.
+        The headers field is set as soon as the file is opened. Uses pyarrow's native parser when it is installed."""
 
-    def readCSV(self) -> Tuple[List[str], List[Dict[str, str]]]:
-        """Reads a csv file from the INPUT_FILE field and converts it into a list of dictionaries."""
+        if pacsv is None:
+            yield from self.readCSVRows()
+        else:
+            yield from self.readCSVBatches()
 
-        dataRows = []
-        with open(self.INPUT_FILE, mode="r") as csvfile:
+    def readCSVRows(self) -> Iterator[Dict[str, str]]:
+        """Reads the INPUT_FILE row by row with the standard library csv reader."""
+
+        # utf-8-sig drops the byte order mark Excel writes, so the first header matches the pyarrow path
+        with open(self.INPUT_FILE, mode="r", encoding="utf-8-sig", newline="") as csvfile:
             reader = csv.reader(csvfile)
-            headers = next(reader)
+            headers = next(reader, [])
+            self.headers = headers
+            width = len(headers)
             for row in reader:
-                dataRow = {}
-                for i, header in enumerate(headers):
-                    try:
-                        dataRow[header] = row[i]
-                    except:
-                        dataRow[header] = ""
-                dataRows += [dataRow]
+                # Pad short rows with empty strings; zip drops any values beyond the last header
+                if len(row) < width:
+                    row += [""] * (width - len(row))
+                yield dict(zip(headers, row))
 
-        return headers, dataRows
+    def readCSVBatches(self) -> Iterator[Dict[str, str]]:
+        """Reads the INPUT_FILE in record batches with pyarrow's streaming native parser, so the whole table is never
+        materialized. Every column is read as a string to keep leading zeros in phone numbers."""
 
-    def postAllSMS(self):
+        # The headers are parsed the same way as readCSVRows and handed to pyarrow, so both readers use identical keys
+        with open(self.INPUT_FILE, mode="r", encoding="utf-8-sig", newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            headers = next(reader, [])
+            hasRows = next(reader, None) is not None
+        self.headers = headers
+
+        # pyarrow cannot skip the header of a file that has nothing after it
+        if not headers or not hasRows:
+            return
+
+        # pyarrow rejects rows with the wrong number of values; they are set aside by row number, then padded
+        # like readCSVRows does and yielded back in their original position
+        width = len(headers)
+        malformed: List[Tuple[float, str]] = []
+
+        def setAside(row) -> str:
+            number = row.number if row.number is not None and row.number > 0 else math.inf
+            heapq.heappush(malformed, (number, row.text))
+            return "skip"
+
+        def padded(text: str) -> Dict[str, str]:
+            row = next(csv.reader([text]), [])
+            if len(row) < width:
+                row += [""] * (width - len(row))
+            return dict(zip(headers, row))
+
+        reader = pacsv.open_csv(
+            self.INPUT_FILE,
+            read_options=pacsv.ReadOptions(column_names=headers, skip_rows=1, autogenerate_column_names=False),
+            parse_options=pacsv.ParseOptions(ignore_empty_lines=False, invalid_row_handler=setAside),
+            convert_options=pacsv.ConvertOptions(column_types={header: pa.string() for header in headers}),
+        )
+
+        # Row numbers are 1-based and the header is row 1
+        number = 2
+        for batch in reader:
+            for dataRow in batch.to_pylist():
+                while malformed and malformed[0][0] <= number:
+                    yield padded(heapq.heappop(malformed)[1])
+                    number += 1
+                yield dataRow
+                number += 1
+
+        while malformed:
+            yield padded(heapq.heappop(malformed)[1])
+
+    async def postAllSMS(self):
         """Runs the postSMS method for all clients in ClientCollections, then prints out the number of
-        successes and failures, and writes out all failed SMS posts to a CSV file."""
-        out = []
+        successes and failures, and writes out all failed SMS posts to a CSV file.
+
+        Reading clients, sending SMS and writing failures run as three concurrent stages joined by bounded
+        queues, so a slow stage applies backpressure to the one before it."""
+
+        # Small inputs only get as many workers as they have clients
+        head = list(islice(self.clientList, self.MAX_CONCURRENCY))
+        workers = max(len(head), 1)
+
+        clients: asyncio.Queue = asyncio.Queue(maxsize=ClientCollection.MAX_PENDING)
+        results: asyncio.Queue = asyncio.Queue(maxsize=ClientCollection.MAX_PENDING)
+
+        # Separate connect and read budgets so a slow connect fails fast without eating the whole deadline
+        timeout = aiohttp.ClientTimeout(total=10, connect=2, sock_connect=2, sock_read=5)
+
+        # Pooled keep-alive connections so the TLS handshake is paid once per connection, not per SMS.
+        # Both the pool and the number of sending workers are capped to stay within the MailJet rate limit.
+        connector = aiohttp.TCPConnector(
+            limit=self.MAX_CONCURRENCY, limit_per_host=self.MAX_CONCURRENCY, ttl_dns_cache=300
+        )
+
+        # Identical messages to the same number are only sent once, and every duplicate row shares its outcome.
+        # Only the (error, errorMessage) outcome is kept per payload, and the oldest payloads are forgotten past
+        # DEDUP_SIZE, so memory stays bounded; a duplicate that far apart is simply sent again.
+        sent: Dict[bytes, Union[asyncio.Future, Tuple[bool, str]]] = {}
+
+        async def send(client: Client) -> Dict[str, Any]:
+            if client.invalidMessage:
+                return await client.postSMS(session)
+
+            # A short digest keeps each remembered key small, whatever the length of the message
+            key = hashlib.blake2b(client.payload, digest_size=16).digest()
+            if key in sent:
+                outcome = sent[key]
+
+                # The first send of this message may still be in flight
+                if isinstance(outcome, asyncio.Future):
+                    outcome = await outcome
+
+                error, errorMessage = outcome
+                return {"error": error, "errorMessage": errorMessage, "client": client.fields}
+
+            if len(sent) >= ClientCollection.DEDUP_SIZE:
+                del sent[next(iter(sent))]
+
+            future = sent[key] = asyncio.get_running_loop().create_future()
+            try:
+                result = await client.postSMS(session)
+            except BaseException:
+                # Wake any duplicates waiting on this send instead of leaving them blocked forever
+                future.cancel()
+                if sent.get(key) is future:
+                    del sent[key]
+                raise
+            outcome = (result["error"], result["errorMessage"])
+            future.set_result(outcome)
+
+            # Once settled, only the outcome itself needs to be remembered
+            if sent.get(key) is future:
+                sent[key] = outcome
+            return result
+
+        async def produce():
+            for client in chain(head, self.clientList):
+                await clients.put(client)
+
+            # One end marker per worker
+            for _ in range(workers):
+                await clients.put(None)
+
+        async def work():
+            while True:
+                client = await clients.get()
+                if client is None:
+                    return
+                await results.put(await send(client))
+
+        async def sendAll():
+            await asyncio.gather(*(work() for _ in range(workers)))
+            await results.put(None)
+
+        # A single event loop multiplexes every request over one shared session
+        async with aiohttp.ClientSession(headers=self.requestHeaders, timeout=timeout, connector=connector) as session:
+            _, _, (success, failure) = await asyncio.gather(produce(), sendAll(), self.writeResults(results))
+
+        print(f"Successes: {success}, Failures: {failure}")
+
+    async def writeResults(self, results: asyncio.Queue) -> Tuple[int, int]:
+        """Consumes postSMS results from the queue until a None end marker, writing every failed client to the
+        CSV file designated by the OUTPUT_FILE field with its error message. Returns the success and failure counts."""
+
         success = 0
         failure = 0
 
-        # https://stackoverflow.com/questions/2632520/what-is-the-fastest-way-to-send-100-000-http-requests-in-python
-        with concurrent.futures.ThreadPoolExecutor(max_workers=100) as executor:
-            # Create collection of futures
-            fs = (executor.submit(client.postSMS, self.MAILJET_TOKEN, self.SENDER_NAME) for client in self.clientList)
+        # A large write buffer keeps the number of write syscalls low for long failure lists. The headers are
+        # already set, since postAllSMS peeks at the first clients before any stage starts.
+        with open(self.OUTPUT_FILE, "w", encoding="utf8", newline="", buffering=1024 * 1024) as out:
+            dw = csv.DictWriter(out, self.headers + ["errorMessage"])
+            dw.writeheader()
 
-            # Iterate through futures
-            for f in concurrent.futures.as_completed(fs):
-                clientDict = f.result()["client"]
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+
+                clientDict = result["client"]
 
                 # If the request failed
-                if f.result()["error"]:
+                if result["error"]:
                     failure += 1
-                    clientDict["errorMessage"] = f.result()["errorMessage"]
-                    out += [clientDict]
+                    clientDict["errorMessage"] = result["errorMessage"]
+                    dw.writerow(clientDict)
                 else:
                     success += 1
 
-        print(f"Successes: {success}, Failures: {failure}")
-        self.writeCSV(out)
-
-    def writeCSV(self, rows: List[Dict[str, Any]]):
-        """Outputs a list of same dictionary items to a CSV file designated by the OUTPUT_FILE field.
-        The rows object must be a list of dictionaries with the same keys as the headers."""
-
-        with open(self.OUTPUT_FILE, "w", encoding="utf8", newline="") as out:
-            dw = csv.DictWriter(out, self.headers + ["errorMessage"])
-            dw.writeheader()
-            dw.writerows(rows)
+        return success, failure
 
 
 if __name__ == "__main__":
-    cc = ClientCollection.getInstance()
+    cc = ClientCollection()
     cc.loadClients()
-    cc.postAllSMS()
+    asyncio.run(cc.postAllSMS())
@@ -0,0 +1,244 @@
+import asyncio
+import email.utils
+import time
+
+import pytest
+
+import main
+
+requiresArrow = pytest.mark.skipif(main.pacsv is None, reason="pyarrow is not installed")
+
+
+def readBoth(path):
+    """Reads the CSV file at path with both readers, returning each reader's headers and rows."""
+    cc = main.ClientCollection()
+    cc.INPUT_FILE = str(path)
+
+    rows = list(cc.readCSVRows())
+    headers = cc.headers
+    batches = list(cc.readCSVBatches())
+    return (headers, rows), (cc.headers, batches)
+
+
+@requiresArrow
+def test_readers_agree_on_bom_file(tmp_path):
+    path = tmp_path / "in.csv"
+    path.write_text("﻿number,text\n0466666666,hi\n", encoding="utf8")
+
+    stdlib, arrow = readBoth(path)
+
+    assert stdlib == arrow
+    assert arrow == (["number", "text"], [{"number": "0466666666", "text": "hi"}])
+
+
+@requiresArrow
+@pytest.mark.parametrize("content", ["", "name,number,text", "name,number,text\n", "name,number,text\n\n"])
+def test_readers_agree_on_files_without_data_rows(tmp_path, content):
+    path = tmp_path / "in.csv"
+    path.write_text(content, encoding="utf8")
+
+    stdlib, arrow = readBoth(path)
+
+    assert stdlib == arrow
+
+
+@requiresArrow
+def test_readers_agree_on_malformed_rows(tmp_path):
+    path = tmp_path / "in.csv"
+    path.write_text(
+        'name,number,text\na,0466,"hi, there"\nb,0477\n\nc,1,2,3,4\nd,,\n"e ""q""",0400,"multi\nline"\nf,0411,x\n',
+        encoding="utf8",
+    )
+
+    stdlib, arrow = readBoth(path)
+
+    assert stdlib == arrow
+    assert [row["name"] for row in arrow[1]] == ["a", "b", "", "c", "d", 'e "q"', "f"]
+
+
+@requiresArrow
+def test_readers_keep_row_order_across_batches(tmp_path):
+    path = tmp_path / "in.csv"
+    lines = ["name,number,text"]
+    for i in range(300_000):
+        lines.append(f"{i},0466" if i % 997 == 0 else f"{i},0466,hi")
+    path.write_text("\n".join(lines) + "\n", encoding="utf8")
+
+    stdlib, arrow = readBoth(path)
+
+    assert stdlib == arrow
+    assert [row["name"] for row in arrow[1][:2]] == ["0", "1"]
+
+
+def test_retry_delay_uses_retry_after_seconds():
+    assert main.Client.retryDelay("3", 0) == 3.0
+
+
+def test_retry_delay_uses_retry_after_date():
+    retryAfter = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < main.Client.retryDelay(retryAfter, 0) <= 30
+
+
+def test_retry_delay_falls_back_to_backoff():
+    assert main.Client.retryDelay(None, 2) == main.Client.RETRY_BACKOFF * 4
+    assert main.Client.retryDelay("soon", 0) == main.Client.RETRY_BACKOFF
+
+
+def test_retry_delay_is_capped():
+    assert main.Client.retryDelay("86400", 0) == main.Client.RETRY_MAX_DELAY
+
+    retryAfter = email.utils.formatdate(time.time() + 86400, usegmt=True)
+    assert main.Client.retryDelay(retryAfter, 0) == main.Client.RETRY_MAX_DELAY
+
+
+class StubResponse:
+    def __init__(self, status, body, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def read(self):
+        return self.body
+
+
+class StubSession:
+    """Replays a fixed list of responses to successive posts."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.posts = 0
+
+    def post(self, url, data=None):
+        self.posts += 1
+        return self.responses.pop(0)
+
+
+def stubSleep(monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    return delays
+
+
+def test_post_sms_retries_rate_limited_request(monkeypatch):
+    delays = stubSleep(monkeypatch)
+    session = StubSession([StubResponse(429, b"", {"Retry-After": "2"}), StubResponse(200, b'{"To": "x"}')])
+    client = main.Client({"number": "0466666666", "text": "hi"}, "sender")
+
+    result = asyncio.run(client.postSMS(session))
+
+    assert result["error"] is False
+    assert session.posts == 2
+    assert delays == [2.0]
+
+
+def test_post_sms_gives_up_after_retry_total(monkeypatch):
+    delays = stubSleep(monkeypatch)
+    session = StubSession([StubResponse(429, b'{"StatusCode": 429, "ErrorMessage": "Too many requests"}')] * 10)
+    client = main.Client({"number": "0466666666", "text": "hi"}, "sender")
+
+    result = asyncio.run(client.postSMS(session))
+
+    assert result["error"] is True
+    assert result["errorMessage"] == "Too many requests"
+    assert session.posts == main.Client.RETRY_TOTAL + 1
+    assert len(delays) == main.Client.RETRY_TOTAL
+
+
+def test_positive_int_env(monkeypatch):
+    monkeypatch.delenv("MAX_CONCURRENCY", raising=False)
+    assert main.getPositiveIntEnv("MAX_CONCURRENCY", 50) == 50
+
+    monkeypatch.setenv("MAX_CONCURRENCY", "7")
+    assert main.getPositiveIntEnv("MAX_CONCURRENCY", 50) == 7
+
+    for value in ("abc", "0", "-3"):
+        monkeypatch.setenv("MAX_CONCURRENCY", value)
+        with pytest.raises(ValueError, match="MAX_CONCURRENCY must be a positive integer"):
+            main.getPositiveIntEnv("MAX_CONCURRENCY", 50)
+
+
+def loadCollection(tmp_path, monkeypatch, lines, concurrency, postSMS):
+    """Builds a ClientCollection over the CSV lines with a stubbed Client.postSMS."""
+    monkeypatch.setattr(main.Client, "postSMS", postSMS)
+    path = tmp_path / "in.csv"
+    path.write_text("\n".join(["name,number,text"] + lines) + "\n", encoding="utf8")
+
+    cc = main.ClientCollection()
+    cc.INPUT_FILE = str(path)
+    cc.OUTPUT_FILE = str(tmp_path / "out.csv")
+    cc.MAX_CONCURRENCY = concurrency
+    cc.loadClients()
+    return cc
+
+
+def runPostAllSMS(tmp_path, monkeypatch, lines, concurrency, postSMS):
+    """Runs postAllSMS over the CSV lines with a stubbed Client.postSMS, returning the output CSV lines."""
+    cc = loadCollection(tmp_path, monkeypatch, lines, concurrency, postSMS)
+    asyncio.run(asyncio.wait_for(cc.postAllSMS(), 5))
+
+    return (tmp_path / "out.csv").read_text(encoding="utf8").splitlines()
+
+
+@pytest.mark.parametrize("concurrency", [1, 50])
+def test_duplicate_rows_are_sent_once(tmp_path, monkeypatch, concurrency):
+    sends = []
+
+    async def postSMS(self, session):
+        sends.append(self.fields["name"])
+        await asyncio.sleep(0.01)
+        return {"error": True, "errorMessage": f"rejected {self.fields['text']}", "client": self.fields}
+
+    out = runPostAllSMS(
+        tmp_path, monkeypatch, ["a,0466666666,hi", "b,0466666666,hi", "c,0477777777,hi", "d,0466666666,hi"], concurrency, postSMS
+    )
+
+    assert sorted(sends) == ["a", "c"]
+    assert sorted(out[1:]) == [
+        "a,0466666666,hi,rejected hi",
+        "b,0466666666,hi,rejected hi",
+        "c,0477777777,hi,rejected hi",
+        "d,0466666666,hi,rejected hi",
+    ]
+
+
+@pytest.mark.parametrize("concurrency", [1, 50])
+def test_evicted_duplicates_are_sent_again(tmp_path, monkeypatch, concurrency):
+    sends = []
+
+    async def postSMS(self, session):
+        sends.append(self.fields["name"])
+        await asyncio.sleep(0.01)
+        return {"error": False, "errorMessage": "", "client": self.fields}
+
+    monkeypatch.setattr(main.ClientCollection, "DEDUP_SIZE", 1)
+    runPostAllSMS(tmp_path, monkeypatch, ["a,0466666666,hi", "b,0477777777,hi", "c,0466666666,hi"], concurrency, postSMS)
+
+    assert sorted(sends) == ["a", "b", "c"]
+
+
+def test_cancelled_send_wakes_duplicates(tmp_path, monkeypatch):
+    async def postSMS(self, session):
+        await asyncio.sleep(0.01)
+        raise asyncio.CancelledError()
+
+    cc = loadCollection(tmp_path, monkeypatch, ["a,0466666666,hi", "b,0466666666,hi"], 50, postSMS)
+
+    async def run():
+        with pytest.raises(asyncio.CancelledError):
+            await cc.postAllSMS()
+        await asyncio.sleep(0.05)
+
+        # The duplicate's worker must not be left waiting on the cancelled send
+        return [task for task in asyncio.all_tasks() if task.get_coro().__name__ == "work" and not task.done()]
+
+    assert asyncio.run(run()) == []